@@ -6,21 +6,163 @@ Last modified:  2023.01.24
 
 
 This class contains the following functions (modules):
+    - Slab                      # Integer grid index bounds of a hyperslab
+    - NetCDFTimeIndex           # Converts a NetCDF time variable into a DatetimeIndex
+    - NetCDFExtentIndexer       # Finds the grid index bounds (Slab) covering a lat/lon extent
+    - NetCDFReader              # Reads a variable once, for sharing between functions
     - NetCDFPlotter             # Plots a variable in space and time
     - NetCDFToSHETRAN           # Wrangles NetCDF data into SHETRAN format
+    - ParallelCSVWriter         # Writes a DataFrame of 1 decimal place values to CSV, formatting rows in parallel
     - WFDE5NetCDFClipper        # Clips raw WFDE5 data in NetCDF format to extent of interest
     - ASCtoDfParam              # Reads in ASC data and writes as DataFrame
         
 """
 
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from netCDF4 import Dataset                                                     # Package index page https://pypi.org/project/netCDF4/
+from netCDF4 import num2date
+
+
+#%%
+# Integer grid index bounds of a hyperslab
+# NB j indexes latitude and i indexes longitude, ends are exclusive, and None ends run to the edge of the grid
+
+Slab = namedtuple('Slab', ['j0', 'j1', 'i0', 'i1'])
+
+
+#%%
+# Converts a NetCDF time variable into a DatetimeIndex
+# NB decodes using the variable's own units (e.g. 'hours since 1900-01-01') and calendar attributes
+# NB integer times on a Gregorian calendar (e.g. ERA5) are decoded as a typed datetime64 array, without boxing each date
+# NB other calendars, units and non-integer times fall back to num2date
+
+def NetCDFTimeIndex(TimeVariable,
+                    ):
+    Calendar    = getattr(TimeVariable, 'calendar', 'standard')
+    Times       = np.asarray(TimeVariable[:])
+    Step, _, Origin = TimeVariable.units.partition(' since ')
+    Step        = {'days': 'D', 'hours': 'h', 'minutes': 'm', 'seconds': 's'}.get(Step.strip().lower())
+    
+    if (Calendar.lower() in ('standard', 'gregorian', 'proleptic_gregorian')
+            and Step is not None
+            and np.issubdtype(Times.dtype, np.integer)):
+        Origin  = pd.Timestamp(Origin.strip())
+        if Origin.tzinfo is None and Origin.year > 1582:                        # Gregorian and proleptic Gregorian calendars agree after 1582
+            Dates   = Origin.to_datetime64() + Times.astype(np.int64).astype('timedelta64[' + Step + ']')
+            return pd.DatetimeIndex(Dates.astype('datetime64[ns]'))
+    
+    Dates       = num2date(Times,
+                           units                        = TimeVariable.units,
+                           calendar                     = Calendar,
+                           only_use_cftime_datetimes    = False,
+                           only_use_python_datetimes    = True)
+    
+    return pd.DatetimeIndex(Dates)
+
+
+#%%
+# Finds the grid index bounds (Slab) covering a lat/lon extent
+# NB cells are included where their centre lies within half a cell of the extent
+# NB handles latitudes ordered north to south (ERA5) or south to north (WFDE5), and longitudes of -180 to 180 or 0 to 360
+# NB raises ValueError if the extent does not overlap the grid, or crosses the 0 degree meridian on a 0 to 360 grid (a Slab cannot split)
+
+def NetCDFExtentIndexer(Data,
+                        North,
+                        South,
+                        West,
+                        East,
+                        LongitudeName,
+                        LatitudeName,
+                        ):
+    Lats        = np.asarray(Data.variables[LatitudeName][:])
+    Lons        = np.asarray(Data.variables[LongitudeName][:])
+    
+    Extent      = ('(North ' + str(North) + ', South ' + str(South)               # User's extent, for error messages
+                   + ', West ' + str(West) + ', East ' + str(East) + ')')
+    
+    if Lons.max() > 180:                                                        # Grid uses 0 to 360 longitudes (e.g. global ERA5-Land)
+        West    = West + 360 if West < 0 else West
+        East    = East + 360 if East < 0 else East
+        if West > East:
+            raise ValueError('NetCDFExtentIndexer: extent ' + Extent + ' crosses the 0 degree meridian on a 0 to 360 grid'
+                             + ', which cannot be read as a single Slab; split it into extents either side of 0 degrees')
+    
+    if len(Lats) > 1:
+        HalfLat = abs(float(Lats[1] - Lats[0])) / 2                             # Half cell size, to include cells overlapping the extent
+        if Lats[0] > Lats[-1]:                                                  # Latitudes descending (north to south)
+            LatIdx  = np.searchsorted(-Lats, [-(North + HalfLat), -(South - HalfLat)], side='right')
+        else:                                                                   # Latitudes ascending (south to north)
+            LatIdx  = np.searchsorted(Lats, [South - HalfLat, North + HalfLat], side='right')
+    else:
+        LatIdx  = [0, 1]                                                        # Single row covers the extent
+    
+    if len(Lons) > 1:
+        HalfLon = abs(float(Lons[1] - Lons[0])) / 2
+        LonIdx  = np.searchsorted(Lons, [West - HalfLon, East + HalfLon], side='right')
+    else:
+        LonIdx  = [0, 1]                                                        # Single column covers the extent
+    
+    if LatIdx[0] >= LatIdx[1] or LonIdx[0] >= LonIdx[1]:
+        raise ValueError('NetCDFExtentIndexer: extent ' + Extent + ' does not overlap the grid'
+                         + ' (latitude ' + str(Lats.min()) + ' to ' + str(Lats.max())
+                         + ', longitude ' + str(Lons.min()) + ' to ' + str(Lons.max()) + ')')
+    
+    return Slab(j0 = int(LatIdx[0]),
+                j1 = int(LatIdx[1]),
+                i0 = int(LonIdx[0]),
+                i1 = int(LonIdx[1]))
+
+
+#%%
+# Reads a variable once, for sharing between NetCDFPlotter and NetCDFToSHETRAN
+# NB returns a dict of the data array (time, lat, lon), its lat and lon vectors, and its dates
+# NB reads in blocks of time aligned to the file's chunks, so each chunk is decompressed once and peak memory stays low
+# NB UnitConversion is applied here, so pass UnitConversion = 1 to functions given this dict
+
+def NetCDFReader(Data,
+                 Variable,
+                 Dates,
+                 LongitudeName,
+                 LatitudeName,
+                 UnitConversion,
+                 IdxSlab = Slab(0, None, 0, None),                              # Whole grid
+                 ):
+    # Unmask NoData cells
+    for k in Data.variables:
+          Data.variables[k].set_auto_mask(False)
+    
+    Var     = Data.variables[Variable]
+    Lats    = Data.variables[LatitudeName][IdxSlab.j0:IdxSlab.j1]
+    Lons    = Data.variables[LongitudeName][IdxSlab.i0:IdxSlab.i1]
+    NTimes  = Var.shape[0]
+    
+    # Choose a time block of whole chunks (at least 256 timesteps, to limit the number of reads)
+    Chunking    = Var.chunking()
+    ChunkTimes  = Chunking[0] if isinstance(Chunking, list) else 1              # Contiguous or NetCDF-3 variables are unchunked
+    TimeBlock   = ChunkTimes * -(-256 // ChunkTimes)
+    
+    # Read the extent of interest block by block, as hyperslabs, into a single precision array
+    VarData = np.empty((NTimes, len(Lats), len(Lons)), dtype=np.float32)      # Single precision is ample for ERA5 (stored as int16 on disk)
+    for Start in range(0, NTimes, TimeBlock):
+        VarData[Start:Start + TimeBlock] = Var[Start:Start + TimeBlock,IdxSlab.j0:IdxSlab.j1,IdxSlab.i0:IdxSlab.i1]
+    
+    if UnitConversion != 1:
+        VarData *= np.float32(UnitConversion)                                   # Convert in place, avoiding a temporary copy
+    
+    return {'Data'  : VarData,
+            'Lat'   : Lats,
+            'Lon'   : Lons,
+            'Time'  : Dates}
 
 
 #%%
 # Plots a variable in space and time
+# NB Data may be a NetCDF Dataset, or a dict prepared by NetCDFReader
 
 def NetCDFPlotter(Variable,
                   Data,
@@ -33,8 +175,12 @@ def NetCDFPlotter(Variable,
                   East,
                   UnitConversion,
                   ):
-    TimeData    = Data.variables[Variable][:,Lon,Lat]*UnitConversion                      # get time series data for a given lon, lat point
-    SpaceData   = Data.variables[Variable][Time,:,:]*UnitConversion                       # get spatial map data for a given time point
+    if isinstance(Data, dict):                                                  # Data already read by NetCDFReader
+        TimeData    = Data['Data'][:,Lon,Lat]*UnitConversion                    # get time series data for a given lon, lat point
+        SpaceData   = Data['Data'][Time,:,:]*UnitConversion                     # get spatial map data for a given time point
+    else:
+        TimeData    = Data.variables[Variable][:,Lon,Lat]*UnitConversion                  # get time series data for a given lon, lat point
+        SpaceData   = Data.variables[Variable][Time,:,:]*UnitConversion                   # get spatial map data for a given time point
 
     
     # Plot time series
@@ -67,6 +213,8 @@ def NetCDFPlotter(Variable,
 # NB for ERA5 , this is north to south, west to east
 # NB for WFDE5, this is south to north, west to 
 # NB for MSWEP, this is north to south, west to east?
+# NB Data may be a NetCDF Dataset, or a dict prepared by NetCDFReader
+# NB for a dict, the data are already read and subset, so LongitudeName and LatitudeName are unused and IdxSlab must be left as the whole grid
 
 
 def NetCDFToSHETRAN(Data,
@@ -77,42 +225,142 @@ def NetCDFToSHETRAN(Data,
                     Path,
                     File,
                     UnitConversion,
+                    IdxSlab         = Slab(0, None, 0, None),                   # Whole grid
+                    Format          = 'csv',
                     ):
-    # Unmask NoData cells
-    for k in Data.variables:
-          Data.variables[k].set_auto_mask(False)
-    
-    # Loop through each cell in grid (e.g. 53 cols, 72 rows = 3816 cells)
-    NCols = len(Data.variables[LongitudeName])
-    NRows = len(Data.variables[LatitudeName])
-    
-    VarTimeSeriesCells = []
+    if isinstance(Data, dict):                                                  # Data already read by NetCDFReader
+        if IdxSlab != Slab(0, None, 0, None):
+            raise ValueError('NetCDFToSHETRAN: IdxSlab cannot be applied to data already read by NetCDFReader; pass it to NetCDFReader instead')
+        VarData = Data['Data']
+        if UnitConversion != 1:
+            VarData = VarData * np.float32(UnitConversion)                      # Convert, leaving the shared array untouched
+    else:
+        VarData = NetCDFReader(Data             = Data,
+                               Variable         = Variable,
+                               Dates            = Dates,
+                               LongitudeName    = LongitudeName,
+                               LatitudeName     = LatitudeName,
+                               UnitConversion   = UnitConversion,
+                               IdxSlab          = IdxSlab)['Data']
     
-    for Lat in range(NRows):                                                    # Loop through Lat
-        for Lon in range(NCols):                                                # Loop through Lon
-            #CellNo = 1 + Lat * NCols + Lon                                     # Initialise at 1, then count position in grid
-            #print('CellNo', CellNo, 'Lat', Lat,'Lon', Lon)                     # Print to check numbering makes sense
-            VarTimeSeries = Data.variables[Variable][:,Lat,Lon]
-            VarTimeSeries = VarTimeSeries * UnitConversion                      # Convert
-            VarTimeSeries = np.round(VarTimeSeries,1)
-            #print(VarTimeSeries)
-            VarTimeSeriesCells.append(VarTimeSeries)
-    #print('NetCDFToSHETRAN: Loop finished')
+    # Flatten grid into one column per cell (e.g. 53 cols, 72 rows = 3816 cells)
+    # NB row-major reshape gives CellNo = Lat * NCols + Lon, i.e. the same numbering as looping Lat then Lon
+    NTimes = VarData.shape[0]
+    VarTimeSeriesCells = VarData.reshape(NTimes, -1)
+    VarTimeSeriesCells = np.round(VarTimeSeriesCells,1)
     
     # Add to Df and add datetime index
-    DfVarTimeSeriesCells = pd.DataFrame(data = VarTimeSeriesCells).transpose()
-    DfVarTimeSeriesCells.index = Data.variables['time'][:]                     # Add datetime index integer, to allow time series concatenation
+    DfVarTimeSeriesCells = pd.DataFrame(data = VarTimeSeriesCells)
     DfVarTimeSeriesCells.index = Dates                                          # Add datetime index DateTime, to allow time series concatenation
     #print('NetCDFToSHETRAN: Var time series added to df')
 
 
-    # Write Df to CSV (where each cell has its own col, ready for SHETRAN)
-    DfVarTimeSeriesCells.to_csv(path_or_buf=(Path + File))
-    #print('NetCDFToSHETRAN: Df written to CSV')
+    if Format == 'csv':
+        # Write Df to CSV (where each cell has its own col, ready for SHETRAN)
+        ParallelCSVWriter(Df    = DfVarTimeSeriesCells,                         # Values are rounded to 1 decimal place above
+                          Path  = Path,
+                          File  = File)
+        #print('NetCDFToSHETRAN: Df written to CSV')
+    
+    elif Format == 'parquet':
+        # Write Df to Parquet (columnar binary, much smaller and faster to write than CSV)
+        import pyarrow as pa                                                    # Package index page https://pypi.org/project/pyarrow/
+        import pyarrow.parquet as pq
+        
+        DfParquet = (DfVarTimeSeriesCells.rename(columns=str)                   # Parquet column names must be strings
+                     .rename_axis(DfVarTimeSeriesCells.index.name or 'dateTime'))
+        pq.write_table(pa.Table.from_pandas(DfParquet),
+                       Path + File,
+                       compression          = 'zstd',
+                       compression_level    = 3)
+        #print('NetCDFToSHETRAN: Df written to Parquet')
+    
+    else:
+        raise ValueError("NetCDFToSHETRAN: Format must be 'csv' or 'parquet', not " + repr(Format))
     
     return DfVarTimeSeriesCells
 
 
+#%%
+# Writes a DataFrame of 1 decimal place values to CSV, formatting rows in parallel
+# NB values must already be rounded to 1 decimal place (as in NetCDFToSHETRAN); output is then identical to Df.to_csv(float_format='%.1f')
+# NB unrounded values are rounded half to even on tenths, so ties (e.g. 0.35) may differ from '%.1f'
+# NB cells are formatted with NumPy integer arithmetic, in the DataFrame's own dtype, one block of rows at a time
+# NB blocks hold about CellBudget cells (whatever the number of columns), so each worker needs roughly 40 bytes per cell of budget
+# NB NumPy releases the GIL, so blocks of rows are formatted concurrently in a thread pool
+# NB blocks containing NaN, infinite or very large (beyond int32 tenths) values fall back to Df.to_csv
+
+def ParallelCSVWriter(Df,
+                      Path,
+                      File,
+                      CellBudget = 1000000,
+                      ):
+    Values = Df.to_numpy()                                                      # Keeps the DataFrame's dtype (e.g. float32), without a copy
+    
+    if Values.size == 0:                                                        # No rows or no cells to format
+        Df.to_csv(path_or_buf=(Path + File), float_format='%.1f')
+        return
+    
+    # Use pandas for the header and index labels only (one short string per row)
+    Header  = Df.iloc[:0].to_csv().encode()
+    Labels  = np.array(Df.iloc[:,:0].to_csv(header=False, lineterminator='\n').splitlines(), dtype=bytes)
+    Newline = np.frombuffer(os.linesep.encode(), dtype=np.uint8)
+    
+    BlockRows = max(1, CellBudget // Values.shape[1])                           # Rows per block, to bound memory for wide extents
+    
+    # Format a block of rows into a fixed-width byte array, where 0 bytes are padding to be dropped
+    def FormatBlock(Start):
+        Block   = Values[Start:Start + BlockRows]
+        NRows   = Block.shape[0]
+        NCols   = Block.shape[1]
+        
+        Lo, Hi  = Block.min(), Block.max()                                      # NaN or infinite values propagate here, without a temporary array
+        if not (np.isfinite(Lo) and np.isfinite(Hi)) or max(-Lo, Hi) >= 2e8:
+            return Df.iloc[Start:Start + NRows].to_csv(header=False, float_format='%.1f').encode()
+        
+        Scaled  = Block * 10
+        np.rint(Scaled, out=Scaled)
+        Tenths  = Scaled.astype(np.int32)
+        del Scaled
+        np.abs(Tenths, out=Tenths)
+        Int     = Tenths // 10
+        np.remainder(Tenths, 10, out=Tenths)                                    # Tenths now holds the decimal digit
+        Digits  = len(str(int(Int.max())))                                      # Width of the largest integer part in this block
+        
+        # Lay out each row as label + cells + newline, with cells as ',' + sign + integer digits + '.' + decimal digit
+        Width   = Digits + 4
+        Label   = Labels.itemsize
+        Rows    = np.zeros((NRows, Label + NCols * Width + Newline.size), dtype=np.uint8)
+        Rows[:,:Label]  = np.frombuffer(Labels[Start:Start + NRows].tobytes(), dtype=np.uint8).reshape(NRows, Label)
+        Rows[:,-Newline.size:] = Newline
+        Cells   = Rows[:,Label:Label + NCols * Width].reshape(NRows, NCols, Width)
+        
+        Cells[:,:,0]    = ord(',')
+        np.multiply(np.signbit(Block), np.uint8(ord('-')), out=Cells[:,:,1])
+        Digit   = np.empty_like(Int)
+        for Position in range(Digits):                                          # Loop over digit positions (not cells), right to left
+            np.remainder(Int, 10, out=Digit)
+            Digit += ord('0')
+            if Position > 0:
+                Digit[Int == 0] = 0                                             # No leading zeros
+            Cells[:,:,Digits + 1 - Position] = Digit
+            Int //= 10
+        Cells[:,:,-2]   = ord('.')
+        Tenths += ord('0')
+        Cells[:,:,-1]   = Tenths
+        
+        return Rows[Rows != 0]
+    
+    # Format blocks in parallel, writing them in order as each batch completes
+    Workers = os.cpu_count() or 1
+    Starts  = range(0, Values.shape[0], BlockRows)
+    with open(Path + File, 'wb') as CSV, ThreadPoolExecutor(max_workers=Workers) as Pool:
+        CSV.write(Header)
+        for Batch in range(0, len(Starts), Workers):                           # Batches bound memory to one block (CellBudget cells) per worker
+            for Text in Pool.map(FormatBlock, Starts[Batch:Batch + Workers]):
+                CSV.write(Text)
+
+
 #%%
 # Clip WFDE5 NetCDF data from globe to specified extent
 def WFDE5NetCDFClipper(Path,
@@ -181,7 +429,7 @@ def ASCtoDfParam(Path,
         
         for Col in range(len(ColList)):                                         # Loop over Cols
             ParamStr                = ColList[Col]                              # ParamStr is a parameter string for a given col in a line
-            DfParam.iloc[Line,Col]  = ParamStr                                  # Write to DfParam
+            DfParam.iat[Line,Col]   = ParamStr                                  # Write to DfParam, by position (no label resolution)
         
     # Convert parameter strings to floats
     DfParam.iloc[:,:] = np.float64(DfParam.iloc[:,:])
@@ -21,6 +21,7 @@ File information:
 Outputs are:
     - An evaporation map for a SHETRAN model (with some GIS processing)
     - An evaporation time series for a SHETRAN model
+    - A cached datetime index ('.time.npy') alongside the ERA5 file, to speed up repeat runs
     
 The user must define:
     - 'FunctionsLibrary' which contains custom functions
@@ -28,6 +29,7 @@ The user must define:
     - 'DirectoryOut' which contains the output TXT files
     - 'FileNameIn' which is the download file name
     - 'FileNameOut' which is the output file name
+    - 'FormatOut' which is the output file format ('csv' for SHETRAN, or 'parquet')
     - 'ExtIn' which is the file extension of the downloaded WFDE5 data
     - 'North'  which is the northern limit of the data domain
     - 'South' which is the southern limit of the data domain
@@ -45,6 +47,7 @@ DirectoryIn         = ''
 DirectoryOut        = ''
 FileNameIn          = ''                                                        # Specify download file name
 FileNameOut         = ''                                                        # Specify output file name
+FormatOut           = 'csv'                                                     # Specify output file format ('csv' for SHETRAN, or 'parquet')
 ExtIn               = '.nc'
 North               = 8.21                                                      # Set coordinates
 South               = 1.09
@@ -60,14 +63,21 @@ EvapList = ['pev',
             'evavt',                                                            # vegetation transpiration
             'evatc']                                                            # top of canopy evaporation
 
+EvapName = EvapList[1]                                                          # Select evaporation variable (total evaporation)
+
 
 #%% Import modules and functions
 
 import os
+import sys
+import numpy as np
 import pandas as pd
 from netCDF4 import Dataset                                                     # Package index page documentation https://pypi.org/project/netCDF4/
 
-os.chdir(FunctionsLibrary)                                                      # Sets working directory to enable custom functions to be used
+sys.path.insert(0, FunctionsLibrary)                                            # Adds directory to module search path to enable custom functions to be used
+from CustomFunctionsToSHETRAN import NetCDFTimeIndex
+from CustomFunctionsToSHETRAN import NetCDFExtentIndexer
+from CustomFunctionsToSHETRAN import NetCDFReader
 from CustomFunctionsToSHETRAN import NetCDFPlotter
 from CustomFunctionsToSHETRAN import NetCDFToSHETRAN
 
@@ -93,8 +103,6 @@ Data can be downloaded using either:
 
 import cdsapi                                                                   # Package index page https://pypi.org/project/cdsapi/
 
-os.chdir(DirectoryIn)
-
 # name client
 c = cdsapi.Client()
 
@@ -132,9 +140,7 @@ c.retrieve(
         ],
         'format': 'netcdf',
     },
-    FileNameIn + ExtIn)
-
-os.chdir(FunctionsLibrary)
+    DirectoryIn + FileNameIn + ExtIn)
 
 '''
 
@@ -142,40 +148,90 @@ os.chdir(FunctionsLibrary)
 
 #%% Read and wrangle ERA5 data
 
+# Skip if the output file is newer than the ERA5 file (i.e. already up to date). NB delete the output file to force a rebuild
+FileIn      = DirectoryIn + FileNameIn + ExtIn
+FileOut     = DirectoryOut + FileNameOut + '.' + FormatOut
+
+if os.path.exists(FileOut) and os.path.getmtime(FileOut) > os.path.getmtime(FileIn):
+    print('Up to date; skipping:', FileOut)
+    sys.exit(0)
+
 # Read in ERA5 file
-ERA5 = Dataset(DirectoryIn + FileNameIn + ExtIn)
+ERA5 = Dataset(FileIn, 'r')
+
+# Enlarge the HDF5 chunk cache (256 MB) for reading the extent of interest. NB NetCDF-3 files (e.g. legacy CDS 'netcdf' downloads) have no chunk cache
+if ERA5.data_model.startswith('NETCDF4'):
+    ERA5.variables[EvapName].set_var_chunk_cache(size       = 256*1024*1024,
+                                                 nelems     = 4133,
+                                                 preemption = 0.75)
 
 # Interrogate data
 ERA5.variables.keys()
 ERA5.variables
 
-# Create datetime index (ERA units are hours since 1900-01-01 00:00:00.0)
-ERA5DateIndex = pd.DataFrame(pd.date_range(start='1900-01-01 00:00:00',
-                                           end = '2030-01-01 00:00:00',
-                                           freq = 'H'))
-
-# Loop through all days in ERA5 data and calculate absolute datetimes
-TimeIndex   = []
-
-# Calculate absolute datetime from ERA5 relative datetime
-for Time in range(len(ERA5.variables['time'])):
-    TimeIndex.append(ERA5DateIndex.loc[ERA5.variables['time'][Time]][0])        # Return time of ERA parameter in hours and match to date
+# Find grid index bounds covering the extent once, so only those cells are read from file
+ERA5Slab = NetCDFExtentIndexer(Data             = ERA5,
+                               North            = North,
+                               South            = South,
+                               West             = West,
+                               East             = East,
+                               LongitudeName    = 'longitude',
+                               LatitudeName     = 'latitude')
+print('Grid index bounds of extent:', ERA5Slab)
 
-# Create DataFrame of timeIndex
-DfTimeIndex = pd.DataFrame(data     = TimeIndex,
-                           columns  = ['dateTime'])
+# Create datetime index (ERA units are hours since 1900-01-01 00:00:00.0)
+# NB the index is cached next to the ERA5 file as int64 nanoseconds (NumPy .npy, no pickle), and rebuilt if the ERA5 file is newer
+# NB a cache that cannot be read, or does not match the ERA5 time variable, is ignored and rebuilt
+TimeCache   = DirectoryIn + FileNameIn + '.time.npy'
+TimeIndex   = None
+
+if os.path.exists(TimeCache) and os.path.getmtime(TimeCache) > os.path.getmtime(FileIn):
+    try:
+        CachedNs    = np.load(TimeCache, allow_pickle=False)                    # Read cached datetime index
+        if CachedNs.dtype == np.int64 and CachedNs.shape == (len(ERA5.variables['time']),):
+            TimeIndex   = pd.DatetimeIndex(CachedNs.view('datetime64[ns]'))
+    except Exception as Error:                                                  # e.g. truncated or damaged cache file
+        print('Datetime index cache ignored:', Error)
+
+if TimeIndex is None:
+    TimeIndex   = NetCDFTimeIndex(ERA5.variables['time'])                       # Calculate absolute datetimes, using the units of the time variable
+    
+    # Write datetime index to cache via a temporary file, so a failed write never leaves a partial cache behind
+    TimeCacheTmp = TimeCache + '.tmp'
+    try:
+        with open(TimeCacheTmp, 'wb') as Cache:
+            np.save(Cache, np.asarray(TimeIndex, dtype='datetime64[ns]').view(np.int64), allow_pickle=False)
+        os.replace(TimeCacheTmp, TimeCache)
+    except OSError as Error:                                                    # e.g. DirectoryIn is read-only or the disk is full
+        print('Datetime index not cached:', Error)
+        if os.path.exists(TimeCacheTmp):
+            os.remove(TimeCacheTmp)
+
+# Name datetime index (used as the datetime column of the output)
+TimeIndex   = pd.DatetimeIndex(TimeIndex, name = 'dateTime')
 
 # Convert datetime to date index
 StartTime   = TimeIndex[0]
 EndTime     = TimeIndex[-1]
-StartIdx    = DfTimeIndex.index[DfTimeIndex['dateTime']==StartTime].tolist()[0]
-EndIdx      = DfTimeIndex.index[DfTimeIndex['dateTime']==EndTime].tolist()[0]
+StartIdx    = TimeIndex.get_loc(StartTime)                                      # Binary search, as ERA5 times are sorted
+EndIdx      = TimeIndex.get_loc(EndTime)
+
+
+#%% Read evaporation once, for the extent of interest, to share between plotting and wrangling
+
+ERA5Evap = NetCDFReader(Data            = ERA5,
+                        Variable        = EvapName,
+                        Dates           = TimeIndex,
+                        LongitudeName   = 'longitude',
+                        LatitudeName    = 'latitude',
+                        UnitConversion  = 1000,
+                        IdxSlab         = ERA5Slab)
 
 
 #%% Plot map of time point, and time series of point
 
-NetCDFPlotter(Variable          = EvapList[1],
-              Data              = ERA5,
+NetCDFPlotter(Variable          = EvapName,
+              Data              = ERA5Evap,
               Time              = 0,
               Lon               = 0,
               Lat               = 0,
@@ -183,20 +239,21 @@ NetCDFPlotter(Variable          = EvapList[1],
               North             = 72,
               West              = 0,
               East              = 53,
-              UnitConversion    = 1000,
+              UnitConversion    = 1,                                            # Already applied by NetCDFReader
               )
 
 
 #%% Wrangle Data into SHETRAN format using NetCDFToSHETRAN function
 
-NetCDFToSHETRAN(Data            = ERA5,
-                Variable        = EvapList[1],
-                Dates           = DfTimeIndex['dateTime'],
+NetCDFToSHETRAN(Data            = ERA5Evap,
+                Variable        = EvapName,
+                Dates           = TimeIndex,
                 LongitudeName   = 'longitude',
                 LatitudeName    = 'latitude',
                 Path            = DirectoryOut,
-                File            = FileNameOut + '.csv',
-                UnitConversion  = 1000)
+                File            = FileNameOut + '.' + FormatOut,
+                UnitConversion  = 1,                                            # Already applied by NetCDFReader
+                Format          = FormatOut)
 
 
 #%% Close the file